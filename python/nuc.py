@@ -4,68 +4,166 @@ import struct
 from functools import partial
 import operator
 import array
-import copy
 import time
 import re
 
 sys.path.append("../shell")
 import swapforth
 
-def truth(pred):
-    return [0, -1][pred]
+_TF = (0, -1)               # Forth flag for a Python truth value
 
 def setimmediate(func):
     func.is_immediate = True
     return func
 
-def ba(x):
-    return array.array('B', x)
+isforth = re.compile(r"[A-Z0-9<>=\-\[\],@!:;+?/*]+$").match
+spaces = re.compile(b" *").match
+
+def tobytes(s):
+    # Forth characters are bytes, read and written as Latin-1 text.
+    # Input characters beyond Latin-1 become '?'
+    return s.encode('latin-1', 'replace')
+
+def forthwords(cls):
+    # (Forth name, method name) for each Forth word defined by a method
+    # of cls. If the method name is not a legal Forth name, the Forth
+    # name is the start of its docstring.
+    r = []
+    for name in dir(cls):
+        o = getattr(cls, name)
+        if not callable(o):
+            continue
+        if isforth(name):
+            r.append((name, name))
+        elif o.__doc__ and isforth(o.__doc__.split()[0]):
+            r.append((o.__doc__.split()[0], name))
+    return r
+
+digitruns = {}
+
+def digitrun(base):
+    # regex matching a run of digits in base
+    if base not in digitruns:
+        if 2 <= base <= 36:
+            digits = "0123456789abcdefghijklmnopqrstuvwxyz"[:base]
+            pattern = "[%s]*" % (digits + digits[10:].upper())
+        else:
+            pattern = ""
+        digitruns[base] = re.compile(pattern.encode('ascii'))
+    return digitruns[base]
+
+# Compiled code is a sequence of (op, arg) pairs, run by SwapForth.inner
+# and stored in a Code
+
+OP_PRIM = 0         # call arg, a Python callable
+OP_CALL = 1         # run arg, the code of a colon definition
+OP_LIT = 2          # push arg
+OP_BRANCH = 3       # jump to arg
+OP_ZBRANCH = 4      # pop, jump to arg if zero
+OP_DO = 5           # start a DO loop
+OP_LOOP = 6         # step a DO loop by arg (None: pop it), push its finish flag
+OP_LITPLUS = 7      # add arg to top of stack
+OP_LITFETCH = 8     # push the cell at address arg
+OP_DOES = 9         # make the last word run arg, a DOES> body
+OP_EXIT = 10        # return from this colon definition
+
+class Code:
+    """ Compiled code, held as parallel arrays of opcodes and their args """
+
+    def __init__(self, pairs = ()):
+        self.ops = array.array('B')
+        self.args = []
+        for c in pairs:
+            self.append(c)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __getitem__(self, i):
+        return (self.ops[i], self.args[i])
+
+    def __setitem__(self, i, c):
+        (self.ops[i], self.args[i]) = c
+
+    def append(self, c):
+        (op, arg) = c
+        self.ops.append(op)
+        self.args.append(arg)
+
+    def freeze(self):
+        self.args = tuple(self.args)
+
+    def frozen(self):
+        return isinstance(self.args, tuple)
 
 class ForthException(Exception):
     def __init__(self, value):
         self.value = value
 
+class Exit(Exception):
+    # raised by EXIT when it is not compiled as OP_EXIT, to return
+    # from the colon definition running it
+    pass
+
 class SwapForth:
 
     def __init__(self, CELL = 4, ENDIAN = '<'):
         self.d = []                 # data stack
         self.r = []                 # return stack
         self.dict = {}              # the dictionary
+        self.shadowed = []          # (name, word) for each word redefined since the first marker
+        self.markers = 0            # number of markers that can still run
         self.xts = []               # execution token (xt) table
-        self.ip = 0                 # instruction pointer for inner interpreter
+        self.xtmap = {}             # callable to its xt
         self.loopC = 0              # loop count
         self.loopL = 0              # loop limit
         self.leaves = []            # tracking LEAVEs from DO..LOOP
-        self.ram = array.array('B') # memory
+        self.ram = bytearray()      # memory
         self.out = sys.stdout.write # default console output
 
         self.CELL = CELL
         self.CSIGN = (256 ** self.CELL) >> 1      # Sign bit mask
         self.CMASK = (256 ** self.CELL) - 1       # Cell mask
-        self.cellfmt = ENDIAN + {2: 'h', 4: 'i', 8: 'q'}[self.CELL]
+        cell = struct.Struct(ENDIAN + {2: 'h', 4: 'i', 8: 'q'}[self.CELL])
+        (self.packcell, self.packcell_into, self.unpackcell_from) = (cell.pack, cell.pack_into, cell.unpack_from)
 
         def allot(n, d):
-            r = partial(self.lit, len(self.ram))
-            r.__doc__ = d
-            self.ram.extend([0] * n)
-            return r
-
-        self.tib = allot(256, "TIB")
-        self.sourcea = allot(self.CELL, "SOURCEA")
-        self.sourcec = allot(self.CELL, "SOURCEC")
-        self.to_in = allot(self.CELL, ">IN")
-        self.base = allot(self.CELL, "BASE")
-        self.state = allot(self.CELL, "STATE")
-
-        # Run through own bound methods, adding each to the dict
-        isforth = re.compile(r"[A-Z0-9<>=\-\[\],@!:;+?/*]+$")
-        for name in dir(self):
-            o = getattr(self, name)
-            if not isforth.match(name) and o.__doc__:
-                # name was not a valid Forth name; try start of the docstring
-                name = o.__doc__.split()[0]
-            if callable(o) and isforth.match(name):
-                self.dict[name] = o
+            a = len(self.ram)
+            self.dict[d] = partial(self.lit, a)
+            self.ram.extend(bytearray(n))
+            return a
+
+        # Each variable is a word pushing its address, and that address
+        self.tib_a = allot(256, "TIB")
+        self.sourcea_a = allot(self.CELL, "SOURCEA")
+        self.sourcec_a = allot(self.CELL, "SOURCEC")
+        self.to_in_a = allot(self.CELL, ">IN")
+        self.base_a = allot(self.CELL, "BASE")
+        self.state_a = allot(self.CELL, "STATE")
+
+        # Add each Forth word method to the dict. The scan of the
+        # class is done once, on its first instance
+        cls = self.__class__
+        if 'primitives' not in cls.__dict__:
+            cls.primitives = forthwords(cls)
+        for (name, method) in cls.primitives:
+            self.dict[name] = getattr(self, method)
+
+        # Superinstructions: pairs of primitives compiled as one
+        self.fusions = {
+            (self.DUP, self.star):      self.dup_star,
+            (self.SWAP, self.DROP):     self.NIP,
+            (self.OVER, self.plus):     self.over_plus,
+            (self.two_dup, self.equal): self.two_dup_equal,
+            (self.to_r, self.to_r):     self.to_r_to_r,
+            (self.r_from, self.r_from): self.r_from_r_from,
+        }
+        # ... and a literal followed by a primitive
+        self.litfusions = {
+            self.plus:  lambda n: (OP_LITPLUS, n),
+            self.minus: lambda n: (OP_LITPLUS, -n),
+            self.fetch: lambda a: (OP_LITFETCH, a),
+        }
 
         self.DECIMAL()
 
@@ -73,18 +171,21 @@ class SwapForth:
         return x & self.CMASK
 
     def w32(self, x):
-        x += self.CSIGN
-        x &= self.CMASK
-        x -= self.CSIGN
-        return x
+        return ((x + self.CSIGN) & self.CMASK) - self.CSIGN
 
     def lit(self, n):
         """ push literal N on the stack """
         self.d.append(n)
 
+    def peek(self, a):
+        return self.unpackcell_from(self.ram, a)[0]
+
+    def poke(self, a, x):
+        self.packcell_into(self.ram, a, x)
+
     def popn(self, n):
         r = self.d[-n:]
-        self.d = self.d[:-n]
+        del self.d[-n:]
         return r
 
     def q(self, s):
@@ -95,22 +196,25 @@ class SwapForth:
                 self.lit(int(w))
 
     def binary(self, op):
-        b = self.d.pop()
-        self.d[-1] = self.w32(op(self.d[-1], b))
+        d = self.d
+        b = d.pop()
+        d[-1] = self.w32(op(d[-1], b))
 
     def dpop(self):
-        r = self.d.pop() << (8 * self.CELL)
-        r += self.d.pop() & self.CMASK
+        d_pop = self.d.pop
+        r = d_pop() << (8 * self.CELL)
+        r += d_pop() & self.CMASK
         return r
 
     def dlit(self, d):
-        self.lit(self.w32(d & self.CMASK))
-        self.lit(self.w32(d >> (8 * self.CELL)))
+        (d_append, w32) = (self.d.append, self.w32)
+        d_append(w32(d & self.CMASK))
+        d_append(w32(d >> (8 * self.CELL)))
 
     def pops(self):
         n = self.d.pop()
         a = self.d.pop()
-        return self.ram[a:a+n].tostring()
+        return bytes(self.ram[a:a+n]).decode('latin-1')
 
     # Start of Forth words
     #
@@ -126,24 +230,34 @@ class SwapForth:
         if e:
             raise ForthException(e)
 
+    def source_spec(self):
+        # (SOURCEA, SOURCEC, >IN), to be restored by set_source_spec
+        peek = self.peek
+        return (peek(self.sourcea_a), peek(self.sourcec_a), peek(self.to_in_a))
+
+    def set_source_spec(self, spec):
+        poke = self.poke
+        (sa, sc, toin) = spec
+        poke(self.sourcea_a, sa)
+        poke(self.sourcec_a, sc)
+        poke(self.to_in_a, toin)
+
     def CATCH(self):
-        self.q('SOURCEA @ SOURCEC @ >IN @')
-        source_spec = self.popn(3)
-        (ds,rs,ip) = (len(self.d) - 1, len(self.r), self.ip)
+        source_spec = self.source_spec()
+        (ds,rs) = (len(self.d) - 1, len(self.r))
         try:
             self.EXECUTE()
         except ForthException as e:
             if len(self.d) > ds:
-                self.d = self.d[:ds]
+                del self.d[ds:]
             else:
-                self.d = self.d + [0] * (ds - len(self.d))
-            self.r = self.r[:rs]
-            self.ip = ip
-            self.lit(source_spec[0])
-            self.lit(source_spec[1])
-            self.lit(source_spec[2])
-            self.q('>IN ! SOURCEC ! SOURCEA !')
+                self.d.extend([0] * (ds - len(self.d)))
+            del self.r[rs:]
+            self.set_source_spec(source_spec)
             self.lit(e.value)
+        except Exit:
+            self.lit(0)     # then return from the caller of CATCH
+            raise
         else:
             self.lit(0)
 
@@ -155,26 +269,28 @@ class SwapForth:
         self.lit(len(self.d))
 
     def SOURCE(self):
-        self.sourcea()
-        self.fetch()
-        self.sourcec()
-        self.fetch()
+        self.d += (self.peek(self.sourcea_a), self.peek(self.sourcec_a))
 
     def fetch(self):
         """ @ """
-        a = self.d.pop()
-        self.lit(*struct.unpack(self.cellfmt, self.ram[a:a + self.CELL]))
+        d = self.d
+        d[-1] = self.unpackcell_from(self.ram, d[-1])[0]
 
     def c_fetch(self):
         """ C@ """
-        a = self.d.pop()
-        self.lit(self.ram[a])
+        d = self.d
+        d[-1] = self.ram[d[-1]]
 
     def store(self):
         """ ! """
-        a = self.d.pop()
-        x = self.d.pop()
-        self.ram[a:a + self.CELL] = array.array('B', struct.pack(self.cellfmt, x))
+        d_pop = self.d.pop
+        a = d_pop()
+        x = d_pop()
+        try:
+            self.packcell_into(self.ram, a, self.w32(x))
+        except struct.error:
+            # past the end of memory
+            self.ram[a:a + self.CELL] = self.packcell(self.w32(x))
 
     def c_store(self):
         """ C! """
@@ -184,53 +300,50 @@ class SwapForth:
 
     def comma(self):
         """ , """
-        self.ram.extend(ba(struct.pack(self.cellfmt, self.d.pop())))
+        self.ram += self.packcell(self.w32(self.d.pop()))
 
     def c_comma(self):
         """ C, """
-        self.ram.extend([self.d.pop()])
+        self.ram.append(self.d.pop() & 0xff)
 
     def slash_string(self):
         """ /STRING """
-        n = self.d.pop()
-        self.d[-2] += n
-        self.d[-1] -= n
+        d = self.d
+        n = d.pop()
+        d[-2] += n
+        d[-1] -= n
+
+    def unparsed(self):
+        # the rest of the parse area, as (start, end) addresses in ram
+        peek = self.peek
+        sa = peek(self.sourcea_a)
+        a = sa + peek(self.to_in_a)
+        return (a, max(a, sa + peek(self.sourcec_a)))
+
+    def parsed(self, a, start, found, end):
+        # push the string from start to the delimiter at found, or to
+        # end if there was none (found < 0), and move >IN past both
+        if found < 0:
+            found = used = end
+        else:
+            used = found + 1
+        self.poke(self.to_in_a, self.peek(self.to_in_a) + used - a)
+        self.d += (start, found - start)
 
     def PARSE(self):
         delim = self.d.pop()
-        self.q('SOURCE >IN @ /STRING')
-
-        self.q('OVER >R')
-        while True:
-            if self.d[-1] == 0:
-                break
-            if (self.ram[self.d[-2]]) == delim:
-                break
-            self.lit(1)
-            self.slash_string()
-
-        self.q('2DUP 1 MIN + SOURCE DROP - >IN !')
-        self.q('DROP R> TUCK -')
+        (a, end) = self.unparsed()
+        if 0 <= delim < 256:
+            self.parsed(a, a, self.ram.find(delim, a, end), end)
+        else:
+            self.parsed(a, a, -1, end)
 
     def parse_name(self):
         """ PARSE-NAME """
-        self.q('SOURCE >IN @ /STRING')
-
-        def skip(pred):
-            while True:
-                if self.d[-1] == 0:
-                    break
-                if not pred(self.ram[self.d[-2]]):
-                    break
-                self.lit(1)
-                self.slash_string()
-
-        skip(lambda x: x == 32)
-        self.q('OVER >R')
-        skip(lambda x: x != 32)
-
-        self.q('2DUP 1 MIN + SOURCE DROP - >IN !')
-        self.q('DROP R> TUCK -')
+        ram = self.ram
+        (a, end) = self.unparsed()
+        start = spaces(ram, a, end).end()
+        self.parsed(a, start, ram.find(b' ', start, end), end)
 
     def DUP(self):
         self.d.append(self.d[-1])
@@ -247,27 +360,31 @@ class SwapForth:
         self.d.pop()
 
     def SWAP(self):
-        (self.d[-2], self.d[-1]) = (self.d[-1], self.d[-2])
+        d = self.d
+        (d[-2], d[-1]) = (d[-1], d[-2])
 
     def two_swap(self):
         """ 2SWAP """
-        (self.d[-4], self.d[-3], self.d[-2], self.d[-1]) = (self.d[-2], self.d[-1], self.d[-4], self.d[-3])
+        d = self.d
+        d[-4:] = d[-2:] + d[-4:-2]
 
     def two_over(self):
         """ 2OVER """
-        self.lit(self.d[-4])
-        self.lit(self.d[-4])
+        d = self.d
+        d += d[-4:-2]
 
     def OVER(self):
-        self.lit(self.d[-2])
+        d = self.d
+        d.append(d[-2])
 
     def TUCK(self):
-        self.SWAP()
-        self.OVER()
+        d = self.d
+        d.insert(-2, d[-1])
 
     def two_dup(self):
         """ 2DUP """
-        self.d += self.d[-2:]
+        d = self.d
+        d += d[-2:]
 
     def to_r(self):
         """ >R """
@@ -285,43 +402,75 @@ class SwapForth:
         """ N>R """
         n = self.d.pop()
         if n:
-            self.r += self.d[-n:]
-            self.d = self.d[:-n]
+            self.r.extend(self.d[-n:])
+            del self.d[-n:]
         self.r.append(n)
 
     def n_r_from(self):
         """ NR> """
         n = self.r.pop()
         if n:
-            self.d += self.r[-n:]
-            self.r = self.r[:-n]
-        self.lit(n)
+            self.d.extend(self.r[-n:])
+            del self.r[-n:]
+        self.d.append(n)
+
+    def dup_star(self):
+        d = self.d
+        d[-1] = self.w32(d[-1] * d[-1])
+
+    def over_plus(self):
+        d = self.d
+        d[-1] = self.w32(d[-2] + d[-1])
+
+    def two_dup_equal(self):
+        d = self.d
+        d.append(_TF[d[-2] == d[-1]])
+
+    def to_r_to_r(self):
+        self.r.append(self.d.pop())
+        self.r.append(self.d.pop())
+
+    def r_from_r_from(self):
+        r_pop = self.r.pop
+        self.d += (r_pop(), r_pop())
 
     def plus(self):
         """ + """
-        self.binary(operator.__add__)
+        d = self.d
+        b = d.pop()
+        d[-1] = self.w32(d[-1] + b)
 
     def minus(self):
         """ - """
-        self.binary(operator.__sub__)
+        d = self.d
+        b = d.pop()
+        d[-1] = self.w32(d[-1] - b)
 
     def _and(self):
         """ AND """
-        self.binary(operator.__and__)
+        d = self.d
+        b = d.pop()
+        d[-1] = self.w32(d[-1] & b)
 
     def _or(self):
         """ OR """
-        self.binary(operator.__or__)
+        d = self.d
+        b = d.pop()
+        d[-1] = self.w32(d[-1] | b)
 
     def _xor(self):
         """ XOR """
-        self.binary(operator.__xor__)
+        d = self.d
+        b = d.pop()
+        d[-1] = self.w32(d[-1] ^ b)
 
     def LSHIFT(self):
         self.binary(operator.__lshift__)
 
     def RSHIFT(self):
-        self.binary(lambda a, b: (a & self.CMASK) >> b)
+        d = self.d
+        b = d.pop()
+        d[-1] = self.w32((d[-1] & self.CMASK) >> b)
 
     def two_slash(self):
         """ 2/ """
@@ -329,15 +478,21 @@ class SwapForth:
 
     def equal(self):
         """ = """
-        self.binary(lambda a, b: truth(a == b))
+        d = self.d
+        b = d.pop()
+        d[-1] = _TF[d[-1] == b]
 
     def less_than(self):
         """ < """
-        self.binary(lambda a, b: truth(a < b))
+        d = self.d
+        b = d.pop()
+        d[-1] = _TF[d[-1] < b]
 
     def u_less_than(self):
         """ U< """
-        self.binary(lambda a, b: truth((a & self.CMASK) < (b & self.CMASK)))
+        (d, m) = (self.d, self.CMASK)
+        b = d.pop()
+        d[-1] = _TF[(d[-1] & m) < (b & m)]
 
     def NEGATE(self):
         self.d[-1] = self.w32(-self.d[-1])
@@ -346,10 +501,16 @@ class SwapForth:
         self.d[-1] = self.w32(self.d[-1] ^ self.CMASK)
 
     def MIN(self):
-        self.lit(min(self.d.pop(), self.d.pop()))
+        d = self.d
+        b = d.pop()
+        if b < d[-1]:
+            d[-1] = b
 
     def MAX(self):
-        self.lit(max(self.d.pop(), self.d.pop()))
+        d = self.d
+        b = d.pop()
+        if b > d[-1]:
+            d[-1] = b
 
     def dplus(self):
         """ D+ """
@@ -357,18 +518,21 @@ class SwapForth:
 
     def u_m_star(self):
         """ UM* """
-        self.dlit(self.u32(self.d.pop()) * self.u32(self.d.pop()))
+        (d_pop, m) = (self.d.pop, self.CMASK)
+        self.dlit((d_pop() & m) * (d_pop() & m))
 
     def star(self):
         """ * """
-        self.binary(operator.__mul__)
+        d = self.d
+        b = d.pop()
+        d[-1] = self.w32(d[-1] * b)
 
     def u_m_slash_mod(self):
         """ UM/MOD """
         u1 = self.u32(self.d.pop())
         ud = self.dpop() & (65536**self.CELL - 1)
         self.lit(self.w32(ud % u1))
-        self.lit(self.w32(ud / u1))
+        self.lit(self.w32(ud // u1))
 
     def MS(self):
         time.sleep(0.001 * self.d.pop())
@@ -391,13 +555,15 @@ class SwapForth:
         self.out(" ".join(self.dict))
 
     def xt(self, c):
-        if not c in self.xts:
+        x = self.xtmap.get(c)
+        if x is None:
+            x = self.xtmap[c] = len(self.xts) + 1000
             self.xts.append(c)
-        return self.xts.index(c) + 1000
+        return x
 
     def SFIND(self):
         (a, n) = self.d[-2:]
-        s = self.ram[a:a+n].tostring().upper()
+        s = bytes(self.ram[a:a+n]).decode('latin-1').upper()
         if s in self.dict:
             x = self.dict[s]
             self.d[-2] = self.xt(x)
@@ -415,36 +581,73 @@ class SwapForth:
     @setimmediate
     def left_paren(self):
         """ [ """
-        self.lit(0)
-        self.state()
-        self.store()
+        self.poke(self.state_a, 0)
 
     def right_paren(self):
         """ ] """
-        self.lit(1)
-        self.state()
-        self.store()
+        self.poke(self.state_a, 1)
 
     def inner(self, code):
-        save = self.ip
-        self.ip = 0
-        while self.ip < len(code):
-            c = code[self.ip]
-            self.ip += 1
-            c()
-        self.ip = save
+        (inner, w32, d) = (self.inner, self.w32, self.d)
+        (ops, args) = (code.ops, code.args)
+        ip = 0
+        n = len(ops)
+        try:
+            while ip < n:
+                op = ops[ip]
+                if op == OP_PRIM:
+                    args[ip]()
+                elif op == OP_CALL:
+                    inner(args[ip])
+                elif op == OP_LIT:
+                    d.append(args[ip])
+                elif op == OP_ZBRANCH:
+                    if d.pop() == 0:
+                        ip = args[ip]
+                        continue
+                elif op == OP_BRANCH:
+                    ip = args[ip]
+                    continue
+                elif op == OP_LITPLUS:
+                    d[-1] = w32(d[-1] + args[ip])
+                elif op == OP_LITFETCH:
+                    d.append(self.peek(args[ip]))
+                elif op == OP_LOOP:
+                    inc = args[ip]
+                    self.doloop(d.pop() if inc is None else inc)
+                elif op == OP_DOES:
+                    self.dodoes(args[ip])
+                elif op == OP_EXIT:
+                    return
+                else:
+                    self.dodo()
+                ip += 1
+        except Exit:
+            pass      # EXIT run by EXECUTE
+
+    def define(self, name, x):
+        if self.markers and name in self.dict:
+            self.shadowed.append((name, self.dict[name]))
+        self.dict[name] = x
 
     def MARKER(self):
         self.parse_name()
         name = self.pops().upper()
-        def restore(here, dict):
+        def restore(here, words, nshadowed, nmarkers):
             del self.ram[here:]
-            self.dict = dict
-        self.dict[name] = partial(restore, len(self.ram), copy.copy(self.dict))
+            while len(self.shadowed) > nshadowed:
+                (w, x) = self.shadowed.pop()
+                self.dict[w] = x
+            for w in [w for w in self.dict if w not in words]:
+                del self.dict[w]
+            self.markers = nmarkers
+        self.define(name, partial(restore, len(self.ram), frozenset(self.dict), len(self.shadowed), self.markers))
+        self.markers += 1
 
     def mkheader(self):
         self.parse_name()
-        self.code = []
+        self.code = Code()
+        self.fence = 0
         self.defining = self.pops().upper()
 
     def colon(self):
@@ -452,10 +655,11 @@ class SwapForth:
         self.mkheader()
         self.right_paren()
         def endcolon():
+            self.code.freeze()
             self.lastword = partial(self.inner, self.code)
             if self.defining in self.dict:
-                print 'warning: refining %s' % self.defining
-            self.dict[self.defining] = self.lastword
+                print('warning: refining %s' % self.defining)
+            self.define(self.defining, self.lastword)
         self.dosemi = endcolon
 
     @setimmediate
@@ -466,13 +670,15 @@ class SwapForth:
 
     @setimmediate
     def RECURSE(self):
-        self.code.append(partial(self.inner, self.code))
+        self.code.append((OP_CALL, self.code))
 
     def noname(self):
         """ :NONAME """
-        self.code = []
+        self.code = Code()
+        self.fence = 0
         self.right_paren()
         def endnoname():
+            self.code.freeze()
             self.lit(self.xt(partial(self.inner, self.code)))
         self.dosemi = endnoname
 
@@ -482,24 +688,28 @@ class SwapForth:
     @setimmediate
     def does(self):
         """ DOES> """
-        def dodoes(code):
-            del self.code[1:]
-            self.code.append(partial(self.inner, code))
-        dobody = []
-        self.code.append(partial(dodoes, dobody))
+        dobody = Code()
+        self.code.append((OP_DOES, dobody))
         self.semicolon()
         self.right_paren()
         self.code = dobody
-        self.dosemi = lambda: 0
+        self.fence = 0
+        self.dosemi = dobody.freeze
+
+    def dodoes(self, code):
+        self.code = Code((self.code[0], (OP_CALL, code)))
+        self.code.freeze()
+        w = partial(self.inner, self.code)
+        w.__dict__.update(self.lastword.__dict__)
+        self.lastword = self.dict[self.defining] = w
 
     def to_body(self):
         """ >BODY """
         code = self.xts[self.d.pop() - 1000].args[0]
-        code0 = code[0]
-        self.inner([code0])
+        self.inner(Code((code[0], )))
 
     def ALLOT(self):
-        self.ram.extend(ba(chr(0) * self.d.pop()))
+        self.ram.extend(bytearray(max(0, self.d.pop())))
 
     @setimmediate
     def POSTPONE(self):
@@ -514,11 +724,12 @@ class SwapForth:
         self.compile_comma()
 
     def EXIT(self):
-        self.ip = 99999999;
+        # compiled as OP_EXIT, see tocode
+        raise Exit()
 
     def ACCEPT(self):
         (a, n) = self.popn(2)
-        s = raw_input()[:n]
+        s = tobytes(input())[:n]
         ns = len(s)
         self.ram[a:a + ns] = s
         self.lit(ns)
@@ -526,76 +737,98 @@ class SwapForth:
     def to_number(self, base = None):
         """ >NUMBER """
         if base is None:
-            self.base()
-            self.fetch()
-            base = self.d.pop()
+            base = self.peek(self.base_a)
 
         (a, n) = self.popn(2)
         ud2 = self.dpop()
-        try:
-            while n:
-                ud2 = base * ud2 + int(chr(self.ram[a]), base)
-                a += 1
-                n -= 1
-        except ValueError:
-            pass
+        run = digitrun(base).match(self.ram, a, a + n).group()
+        # convert in chunks that each fill a double cell in base 2,
+        # keeping only the double cell of the result
+        step = 16 * self.CELL
+        for i in range(0, len(run), step):
+            chunk = run[i:i + step]
+            ud2 = (ud2 * base ** len(chunk) + int(chunk, base)) & (65536**self.CELL - 1)
+        a += len(run)
+        n -= len(run)
         self.dlit(ud2)
         self.lit(a)
         self.lit(n)
 
     def DECIMAL(self):
-        self.lit(10)
-        self.base()
-        self.store()
+        self.poke(self.base_a, 10)
+
+    def tocode(self, c):
+        # the (op, arg) pair that runs callable c
+        if isinstance(c, partial) and c.func == self.inner:
+            code = c.args[0]
+            if code.frozen() and len(code) == 1 and code.ops[0] not in (OP_BRANCH, OP_ZBRANCH, OP_EXIT):
+                return code[0]      # inline a one-op word
+            return (OP_CALL, code)
+        if c == self.EXIT:
+            return (OP_EXIT, None)
+        return (OP_PRIM, c)
 
     def compile_comma(self):
         """ COMPILE, """
-        self.code.append(self.xts[self.d.pop() - 1000])
+        self.fuse(self.tocode(self.xts[self.d.pop() - 1000]))
+
+    def fuse(self, c):
+        # append c to the code, merging it with the previous (op, arg)
+        # pair when they make a superinstruction
+        if len(self.code) > self.fence and c[0] == OP_PRIM:
+            (op, arg) = self.code[-1]
+            if op == OP_PRIM and (arg, c[1]) in self.fusions:
+                self.code[-1] = (OP_PRIM, self.fusions[(arg, c[1])])
+                return
+            if op == OP_LIT and c[1] in self.litfusions:
+                self.code[-1] = self.litfusions[c[1]](arg)
+                return
+        self.code.append(c)
 
-    def branch(self, x):
-        self.ip = x
+    def label(self):
+        # a branch target at the end of the code; no fusing across it
+        self.fence = len(self.code)
+        return self.fence
 
-    def zbranch(self, x):
-        if self.d.pop() == 0:
-            self.ip = x
+    def resolve(self, p):
+        self.code[p] = (self.code[p][0], self.label())
 
     @setimmediate
     def BEGIN(self):
-        self.lit(len(self.code))
+        self.lit(self.label())
 
     @setimmediate
     def AGAIN(self):
-        self.code.append(partial(self.branch, self.d.pop()))
+        self.code.append((OP_BRANCH, self.d.pop()))
 
     @setimmediate
     def AHEAD(self):
         self.lit(len(self.code))
-        self.code.append(self.branch)
+        self.code.append((OP_BRANCH, None))
 
     @setimmediate
     def m_if(self):
         """ IF """
         self.lit(len(self.code))
-        self.code.append(self.zbranch)
+        self.code.append((OP_ZBRANCH, None))
 
     @setimmediate
     def THEN(self):
-        p = self.d.pop()
-        self.code[p] = partial(self.code[p], len(self.code))
+        self.resolve(self.d.pop())
 
     @setimmediate
     def UNTIL(self):
-        self.code.append(partial(self.zbranch, self.d.pop()))
+        self.code.append((OP_ZBRANCH, self.d.pop()))
 
     @setimmediate
     def LITERAL(self):
-        self.code.append(partial(self.lit, self.d.pop()))
+        self.code.append((OP_LIT, self.d.pop()))
 
     def dodo(self):
-        self.r.append(self.loopC)
-        self.r.append(self.loopL)
-        self.loopC = self.d.pop()
-        self.loopL = self.d.pop()
+        self.r += (self.loopC, self.loopL)
+        d_pop = self.d.pop
+        self.loopC = d_pop()
+        self.loopL = d_pop()
 
     def qdodo(self):
         self.r.append(self.loopC)
@@ -604,79 +837,70 @@ class SwapForth:
         self.loopL = self.d[-2]
         self._xor()
 
-    def doloop(self):
-        before = self.w32(self.loopC - self.loopL) < 0
-        inc = self.d.pop()
-        self.loopC = self.w32(self.loopC + inc)
-        after = self.w32(self.loopC - self.loopL) < 0
+    def doloop(self, inc):
+        (w32, c, l) = (self.w32, self.loopC, self.loopL)
+        before = w32(c - l) < 0
+        self.loopC = c = w32(c + inc)
+        after = w32(c - l) < 0
         if inc > 0:
-            finish = before > after
+            self.d.append(before > after)
         else:
-            finish = before < after
-        self.lit(finish)
+            self.d.append(before < after)
 
     @setimmediate
     def DO(self):
         self.leaves.append([])
-        self.code.append(self.dodo)
-        self.lit(len(self.code))
+        self.code.append((OP_DO, None))
+        self.lit(self.label())
 
     @setimmediate
     def LOOP(self):
-        self.lit(1)
-        self.LITERAL()
-        self.plus_loop()
+        self.endloop(1)
 
     @setimmediate
     def plus_loop(self):
         """ +LOOP """
-        self.code.append(self.doloop)
+        self.endloop(None)
+
+    def endloop(self, inc):
+        self.code.append((OP_LOOP, inc))
         self.UNTIL()
-        leaves = self.leaves.pop()
-        for p in leaves:
-            self.code[p] = partial(self.code[p], len(self.code))
-        self.code.append(self.UNLOOP)
+        for p in self.leaves.pop():
+            self.resolve(p)
+        self.code.append((OP_PRIM, self.UNLOOP))
 
     @setimmediate
     def question_do(self):
         """ ?DO """
-        self.code.append(self.qdodo)
+        self.code.append((OP_PRIM, self.qdodo))
         self.leaves.append([len(self.code)])
-        self.code.append(self.zbranch)
-        self.lit(len(self.code))
-        return
-
-        self.code.append(self.two_dup)
-        self.code.append(self.equal)
-        self.leaves.append([len(self.code)])
-        self.code.append(self.zbranch)
-        self.code.append(self.dodo)
-        self.lit(len(self.code))
+        self.code.append((OP_ZBRANCH, None))
+        self.lit(self.label())
 
     def I(self):
-        self.lit(self.loopC)
+        self.d.append(self.loopC)
 
     def J(self):
-        self.lit(self.r[-2])
+        self.d.append(self.r[-2])
 
     def UNLOOP(self):
         self.loopL = self.r.pop()
         self.loopC = self.r.pop()
 
     def QUIT(self):
-        print 'QUIT'
+        print('QUIT')
         raise swapforth.Bye
 
     @setimmediate
     def LEAVE(self):
         self.leaves[-1].append(len(self.code))
-        self.code.append(self.branch)
+        self.code.append((OP_BRANCH, None))
 
     def EVALUATE(self):
-        self.q('SOURCE >R >R >IN @ >R')
-        self.q('SOURCEC ! SOURCEA ! 0 >IN !')
+        saved = self.source_spec()
+        self.set_source_spec(self.popn(2) + [0])
         self.interpret()
-        self.q('R> >IN ! R> SOURCEA ! R> SOURCEC !')
+        self.set_source_spec(saved)
 
     def interpret(self):
 
@@ -743,46 +967,41 @@ class SwapForth:
                 break
             self.SFIND()
             i = self.d.pop() + 1
-            self.state()
-            self.fetch()
-            i += 3 * self.d.pop()
-            [ # nonimmediate        number              immediate
-              # ------------        ------              ---------
-                self.EXECUTE,       doubleAlso,         self.EXECUTE,   # interpretation
-                self.compile_comma, doubleAlso_comma,   self.EXECUTE    # compilation
-            ][i]()
+            i += 3 * self.peek(self.state_a)
+            try:
+                [ # nonimmediate        number              immediate
+                  # ------------        ------              ---------
+                    self.EXECUTE,       doubleAlso,         self.EXECUTE,   # interpretation
+                    self.compile_comma, doubleAlso_comma,   self.EXECUTE    # compilation
+                ][i]()
+            except Exit:
+                pass    # EXIT outside any definition does nothing
         self.two_drop()
 
     def REFILL(self):
-        self.tib()
-        self.lit(256)
+        self.d += (self.tib_a, 256)
         self.ACCEPT()
-        self.q('SOURCEC !')
-        self.q('TIB SOURCEA !')
-        self.q('0 >IN !')
+        self.poke(self.sourcec_a, self.d.pop())
+        self.poke(self.sourcea_a, self.tib_a)
+        self.poke(self.to_in_a, 0)
         self.lit(-1)
 
     def putcmd(self, cmd):
         if cmd.endswith('\r'):
             cmd = cmd[:-1]
-        self.tib()
-        tib = self.d.pop()
-        for i,c in enumerate(cmd):
-            self.ram[tib + i] = ord(c)
-        self.q('TIB SOURCEA !')
-        self.lit(len(cmd))
-        self.q('SOURCEC !')
-        self.q('0 >IN !')
+        s = tobytes(cmd)
+        tib = self.tib_a
+        self.ram[tib:tib + len(s)] = s
+        self.poke(self.sourcea_a, tib)
+        self.poke(self.sourcec_a, len(s))
+        self.poke(self.to_in_a, 0)
 
 import threading
-import Queue
-
 class AsyncSwapForth(SwapForth):
 
-    def __init__(self, cmdq, ready, *options):
+    def __init__(self, host, *options):
         SwapForth.__init__(self, *options)
-        self.cmdq = cmdq
-        self.ready = ready
+        self.host = host
         while True:
             self.REFILL()
             if not self.d.pop():
@@ -804,10 +1023,14 @@ class AsyncSwapForth(SwapForth):
 
     def ACCEPT(self):
         (a, n) = self.popn(2)
-        self.ready.set()
-        (self.out, s) = self.cmdq.get()[:n]
+        host = self.host
+        host.ready.set()
+        host.work.wait()
+        host.work.clear()
+        (self.out, s) = host.pending
+        s = tobytes(s)[:n]
         ns = len(s)
-        self.ram[a:a + ns] = ba(s)
+        self.ram[a:a + ns] = s
         self.lit(ns)
 
 class Tethered(swapforth.TetheredFT900):
@@ -817,17 +1040,21 @@ class Tethered(swapforth.TetheredFT900):
         self.ser = None
         self.verbose = False
 
+        # one command at a time is handed to the AsyncSwapForth thread
+        # in pending: work is set when it is there, ready when it is done
         self.ready = threading.Event()
-        self.cmdq = Queue.Queue()
-        self.t = threading.Thread(target = AsyncSwapForth, args = (self.cmdq, self.ready) + options)
-        self.t.setDaemon(True)
+        self.work = threading.Event()
+        self.pending = None
+        self.t = threading.Thread(target = AsyncSwapForth, args = (self, ) + options)
+        self.t.daemon = True
         self.t.start()
         self.ready.wait()
 
     def issue(self, writer, cmd):
         assert self.ready.is_set()
         self.ready.clear()
-        self.cmdq.put((writer, cmd))
+        self.pending = (writer, cmd)
+        self.work.set()
         self.ready.wait()
 
     def interactive_command(self, cmd):
@@ -851,9 +1078,9 @@ if __name__ == '__main__':
         if '-b' in optdict:
             endian = '>'
     except getopt.GetoptError:
-        print "usage:"
-        print " -c N    cell size, one of 2,4 or 8"
-        print " -b      big-endian. Default is little-endian"
+        print("usage:")
+        print(" -c N    cell size, one of 2,4 or 8")
+        print(" -b      big-endian. Default is little-endian")
         sys.exit(1)
 
     dpans = {}
@@ -872,6 +1099,6 @@ if __name__ == '__main__':
         words = set(t.command_response('words').split())
         missing = dpans['CORE'] - words
         print(len(missing), "MISSING CORE", " ".join(sorted(missing)))
-        print words - allw
+        print(words - allw)
 
     t.shell()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
 import sys
 from datetime import datetime
 import time
@@ -9,6 +10,11 @@ import os
 
 import dpansf
 
+try:
+    input = raw_input
+except NameError:
+    pass
+
 class FT900Bootloader:
     def __init__(self, ser):
         ser.setDTR(1)
@@ -43,7 +49,7 @@ class FT900Bootloader:
             return
 
         # Is somewhere else, request manual reset
-        print "Please press RESET on target board"
+        print("Please press RESET on target board")
         while True:
             s = self.ser.read(1)
             # print repr(s)
@@ -65,7 +71,7 @@ class FT900Bootloader:
         if self.verbose:
             t = time.time() - t0
             self.cumcrc += t
-            print 'crc', sz, t, self.cumcrc
+            print('crc', sz, t, self.cumcrc)
         return r
 
     def flashcrc32(self, a, sz):
@@ -75,7 +81,7 @@ class FT900Bootloader:
         if self.verbose:
             t = time.time() - t0
             self.cumcrc += t
-            print 'crc', sz, t, self.cumcrc
+            print('crc', sz, t, self.cumcrc)
         return r
 
     def ex(self, ):
@@ -116,7 +122,7 @@ def collect_screenshot(dest, ser):
     while have != match:
         have = (have + ser.read(1))[-len(match):]
     (w, h) = struct.unpack("II", ser.read(8))
-    print '%dx%d image' % (w, h),
+    print('%dx%d image' % (w, h), end=' ')
     sys.stdout.flush()
     if 0:
         imd = ser.read(4 * w * h)
@@ -149,7 +155,7 @@ def collect_screenshot(dest, ser):
     im = Image.merge("RGBA", (r, g, b, a))
     im.convert("RGB").save(dest)
     took = time.time() - t0
-    print 'took %.1fs. Wrote RGB image to %s' % (took, dest)
+    print('took %.1fs. Wrote RGB image to %s' % (took, dest))
     ser.write('k')
 
 class TetheredFT900:
@@ -159,7 +165,7 @@ class TetheredFT900:
         try:
             import serial
         except:
-            print "This tool needs PySerial, but it was not found"
+            print("This tool needs PySerial, but it was not found")
             sys.exit(1)
         ser = serial.Serial(port, 115200, timeout=None, rtscts=0)
         self.ser = ser
@@ -178,12 +184,12 @@ class TetheredFT900:
         ser.flushInput()
 
         if bl.confirm() != 0xf70a0d13:
-            print 'CONFIRM command failed'
+            print('CONFIRM command failed')
             sys.exit(1)
         bl.setspeed(speed)
 
         if bl.confirm() != 0xf70a0d13:
-            print 'High-speed CONFIRM command failed'
+            print('High-speed CONFIRM command failed')
             sys.exit(1)
         if bootfile is not None:
             program = array.array('I', open(bootfile).read())
@@ -202,10 +208,10 @@ class TetheredFT900:
             pass
 
     def listen(self):
-        print 'listen'
+        print('listen')
         while 1:
             c = self.ser.read(1)
-            print repr(c)
+            print(repr(c))
 
     def command_response(self, cmd):
         ser = self.ser
@@ -253,7 +259,7 @@ class TetheredFT900:
                 while l.endswith('\n') or l.endswith('\r'):
                     l = l[:-1]
                 if self.verbose:
-                    print repr(l)
+                    print(repr(l))
                 if l == "#bye":
                     raise Bye
                 l = l.expandtabs(4)
@@ -269,7 +275,7 @@ class TetheredFT900:
                     if r.endswith(' ok\r\n'):
                         r = r[:-5]
                     if 'error: ' in r:
-                        print '--- ERROR ---'
+                        print('--- ERROR ---')
                         sys.stdout.write(l + '\n')
                         sys.stdout.write(r)
                         raise Bye
@@ -277,7 +283,7 @@ class TetheredFT900:
                         write(r)
                         # print repr(r)
             return
-        print "Cannot find file %s in %r" % (filename, self.searchpath)
+        print("Cannot find file %s in %r" % (filename, self.searchpath))
         raise Bye
 
     def shellcmd(self, cmd):
@@ -287,7 +293,7 @@ class TetheredFT900:
         elif cmd.startswith('#include'):
             cmd = cmd.split()
             if len(cmd) != 2:
-                print 'Usage: #include <source-file>'
+                print('Usage: #include <source-file>')
             else:
                 try:
                     self.include(cmd[1])
@@ -296,14 +302,14 @@ class TetheredFT900:
         elif cmd.startswith('#flash'):
             cmd = cmd.split()
             if len(cmd) != 2:
-                print 'Usage: #flash <dest-file>'
+                print('Usage: #flash <dest-file>')
                 ser.write('\r')
             else:
-                print 'please wait...'
+                print('please wait...')
                 dest = cmd[1]
                 l = self.command_response('serialize')
                 d = [int(x, 36) for x in l.split()[:-1]]
-                print 'Image is', self.cellsize*len(d), 'bytes'
+                print('Image is', self.cellsize*len(d), 'bytes')
                 if self.cellsize == 4:
                     if dest.endswith('.hex'):
                         open(dest, "w").write("".join(["%08x\n" % (x & 0xffffffff) for x in d]))
@@ -325,27 +331,27 @@ class TetheredFT900:
             def pp(s):
                 return " ".join(sorted(s))
             words = sorted((self.command_response('words')).upper().split()[:-1])
-            print 'duplicates:', pp(set([w for w in words if words.count(w) > 1]))
-            print 'have CORE words: ', pp(set(dpansf.words['CORE']) & set(words))
-            print 'missing CORE words: ', pp(set(dpansf.words['CORE']) - set(words))
-            print
-            print pp(words)
+            print('duplicates:', pp(set([w for w in words if words.count(w) > 1])))
+            print('have CORE words: ', pp(set(dpansf.words['CORE']) & set(words)))
+            print('missing CORE words: ', pp(set(dpansf.words['CORE']) - set(words)))
+            print()
+            print(pp(words))
             allwords = {}
             for ws in dpansf.words.values():
                 allwords.update(ws)
-            print 'unknown: ', pp(set(words) - set(allwords))
-            print 'extra:', pp(set(allwords) & (set(words) - set(dpansf.words['CORE'])))
+            print('unknown: ', pp(set(words) - set(allwords)))
+            print('extra:', pp(set(allwords) & (set(words) - set(dpansf.words['CORE']))))
             extra = (set(allwords) & (set(words) - set(dpansf.words['CORE'])))
             for w in sorted(extra):
                 ref = allwords[w]
                 part = ref[:ref.index('.')]
-                print '\href{http://forth.sourceforge.net/std/dpans/dpans%s.htm#%s}{\wordidx{%s}}' % (part, ref, w.lower())
+                print(r'\href{http://forth.sourceforge.net/std/dpans/dpans%s.htm#%s}{\wordidx{%s}}' % (part, ref, w.lower()))
         elif cmd.startswith('#time '):
             t0 = time.time()
             r = self.command_response(cmd[6:])
             t1 = time.time()
-            print r
-            print 'Took %.6f seconds' % (t1 - t0)
+            print(r)
+            print('Took %.6f seconds' % (t1 - t0))
         elif cmd.startswith('#measure'):
             ser = self.ser
             # measure the board's clock
@@ -360,11 +366,11 @@ class TetheredFT900:
                 ser.read(1)
                 t = time.time()
                 n += 1
-                print "%.6f MHz" % ((2 * 100.000000 * n) / (t - t0))
+                print("%.6f MHz" % ((2 * 100.000000 * n) / (t - t0)))
         elif cmd.startswith('#screenshot'):
             cmd = cmd.split()
             if len(cmd) != 2:
-                print 'Usage: #screenshot <dest-image-file>'
+                print('Usage: #screenshot <dest-image-file>')
                 ser.write('\r')
             else:
                 dest = cmd[1]
@@ -374,12 +380,12 @@ class TetheredFT900:
         elif cmd.startswith('#movie'):
             cmd = cmd.split()
             if len(cmd) != 2:
-                print 'Usage: #movie <command>'
+                print('Usage: #movie <command>')
                 ser.write('\r')
             else:
                 dest = cmd[1]
                 ser.write('%s\r' % cmd[1])
-                for i in xrange(10000):
+                for i in range(10000):
                     collect_screenshot("%04d.png" % i, ser)
                 ser.write('\r\n')
         else:
@@ -403,7 +409,7 @@ class TetheredFT900:
 
         if autocomplete:
             words = sorted((self.command_response('words')).split())
-            print 'Loaded', len(words), 'words'
+            print('Loaded', len(words), 'words')
             def completer(text, state):
                 text = text.lower()
                 candidates = [w for w in words if w.startswith(text)]
@@ -425,10 +431,10 @@ class TetheredFT900:
                     prompt = '>'
                 else:
                     prompt = '+'
-                cmd = raw_input(prompt).strip()
+                cmd = input(prompt).strip()
                 self.shellcmd(cmd)
             except KeyboardInterrupt:
-                print
+                print()
                 self.interrupt()
                 # ser.write(chr(3))
                 # ser.flush()
@@ -463,7 +469,7 @@ if __name__ == '__main__':
                 r.boot(image)
                 r.searchpath += searchpath
             if a.startswith('-e'):
-                print r.shellcmd(args[1])
+                print(r.shellcmd(args[1]))
                 args = args[2:]
             else:
                 r.include(a)